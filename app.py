@@ -1,15 +1,25 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify, send_file, flash
-from datetime import datetime, date, time
+from flask import Flask, render_template, request, redirect, url_for, jsonify, send_file, flash, has_request_context
+from datetime import datetime, date, time, timedelta
+from time import monotonic
 from zoneinfo import ZoneInfo
 from io import BytesIO
+import os
+import gzip
+import hashlib
+import mimetypes
 import json
+import re
+import threading
 import pandas as pd
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Date, Text, Float
+from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Date, DateTime, Text, Float, insert, update, delete, select, func, event, inspect
 from sqlalchemy.orm import sessionmaker, declarative_base, relationship
 from docx import Document
+import brotli
 
 app = Flask(__name__)
 app.secret_key = "change-me-in-production"
+# 0 keeps the change log (and its audit trail) forever
+app.config["CHANGE_LOG_RETENTION_DAYS"] = int(os.environ.get("CHANGE_LOG_RETENTION_DAYS", "0"))
 
 engine = create_engine("sqlite:///school_tools.db", echo=False, future=True)
 SessionLocal = sessionmaker(bind=engine, future=True)
@@ -105,8 +115,38 @@ class TestGrade(Base):
     student_id = Column(Integer, ForeignKey("students.id"))
     score = Column(Float, default=0.0)
 
+class ChangeLog(Base):
+    __tablename__ = "change_log"
+    __table_args__ = {"sqlite_autoincrement": True}
+    id = Column(Integer, primary_key=True)       # monotonic sequence, doubles as the version
+    entity = Column(String, nullable=False)      # table name
+    entity_key = Column(String, nullable=False)  # primary key value
+    op = Column(String, nullable=False)          # insert / update / delete
+    source = Column(String, nullable=True)       # "METHOD /path client-ip" when written from a request
+    changed_at = Column(DateTime, nullable=False, index=True)
+
 Base.metadata.create_all(engine)
 
+# Change log
+
+def record_changes(db, entity, keys, op):
+    src = f"{request.method} {request.path} {request.remote_addr}" if has_request_context() else None
+    now = datetime.now(TZ).replace(tzinfo=None)
+    rows = [{"entity": entity, "entity_key": str(k), "op": op, "source": src, "changed_at": now} for k in keys]
+    if rows: db.connection().execute(ChangeLog.__table__.insert(), rows)
+
+@event.listens_for(SessionLocal, "after_flush")
+def log_flush_changes(session, flush_context):
+    changes = {}
+    dirty = [o for o in session.dirty if session.is_modified(o)]
+    for op, objs in (("insert", session.new), ("update", dirty), ("delete", session.deleted)):
+        for obj in objs:
+            if isinstance(obj, ChangeLog): continue
+            pk = inspect(obj).mapper.primary_key_from_instance(obj)
+            changes.setdefault((obj.__tablename__, op), []).append(",".join(map(str, pk)))
+    for (entity, op), keys in changes.items():
+        record_changes(session, entity, keys, op)
+
 # Seed
 
 def seed_defaults():
@@ -134,13 +174,250 @@ def seed_defaults():
 
 seed_defaults()
 
+_MISSING = object()
+
+class ChangeCache:
+    """Per-worker cache whose entries are dropped when the change log reports a write to one of its entities.
+
+    keyed=True means cache keys are the entity's primary keys, so only the changed entry is dropped.
+    """
+    registry = []
+
+    def __init__(self, *entities, keyed=False):
+        self.entities = set(entities); self.keyed = keyed; self.entries = {}
+        ChangeCache.registry.append(self)
+
+    def get(self, key, load):
+        value = self.entries.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        seen = _last_change_id
+        value = load()
+        with _change_lock:
+            # a poll since load() started may have invalidated what we just read; don't pin it
+            if _last_change_id == seen: self.entries[key] = value
+        return value
+
+    def invalidate(self, entity, key):
+        if entity not in self.entities: return
+        if self.keyed: self.entries.pop(key, None)
+        else: self.entries.clear()
+
+PRUNE_INTERVAL_SECONDS = 24*3600
+
+def prune_change_log():
+    # pollers only need rows newer than their watermark; autoincrement keeps ids monotonic after deletes
+    days = app.config["CHANGE_LOG_RETENTION_DAYS"]
+    if days <= 0: return
+    cutoff = datetime.now(TZ).replace(tzinfo=None) - timedelta(days=days)
+    with engine.begin() as conn:
+        conn.execute(delete(ChangeLog).where(ChangeLog.changed_at < cutoff))
+
+def latest_change_id():
+    with engine.connect() as conn:
+        return conn.execute(select(func.max(ChangeLog.id))).scalar() or 0
+
+prune_change_log()
+_last_change_id = latest_change_id()
+_last_prune = monotonic()
+_change_lock = threading.Lock()
+
+def poll_changes():
+    # SQLite serializes writers, so every id up to max(id) is already committed; reading max first
+    # and then only the watched entities below it never skips a commit
+    global _last_change_id
+    with _change_lock:
+        with engine.connect() as conn:
+            latest = conn.execute(select(func.max(ChangeLog.id))).scalar() or 0
+            if latest <= _last_change_id: return
+            watched = set().union(*(c.entities for c in ChangeCache.registry))
+            rows = conn.execute(select(ChangeLog.entity, ChangeLog.entity_key)
+                                .where(ChangeLog.id > _last_change_id, ChangeLog.id <= latest, ChangeLog.entity.in_(watched))
+                                .order_by(ChangeLog.id.asc())).all()
+        for entity, key in rows:
+            for cache in ChangeCache.registry:
+                cache.invalidate(entity, key)
+        _last_change_id = latest
+
+@app.before_request
+def sync_caches():
+    global _last_prune
+    if request.endpoint == "static": return
+    poll_changes()
+    if monotonic() - _last_prune > PRUNE_INTERVAL_SECONDS:
+        _last_prune = monotonic()
+        prune_change_log()
+
+settings_cache = ChangeCache("settings", keyed=True)
+schedule_cache = ChangeCache("schedule", "classes")
+
 def get_setting(key, default=""):
-    db = SessionLocal()
-    try:
-        rec = db.query(Setting).filter_by(key=key).first()
-        return rec.value if rec else default
-    finally:
-        db.close()
+    def load():
+        db = SessionLocal()
+        try:
+            rec = db.query(Setting).filter_by(key=key).first()
+            return rec.value if rec else None
+        finally:
+            db.close()
+    value = settings_cache.get(key, load)
+    return value if value is not None else default
+
+# Roster sync
+
+_AR_MARKS = re.compile(r"[\u0610-\u061A\u064B-\u065F\u0670\u0640]")  # harakat + tatweel
+_AR_LETTERS = str.maketrans({"أ":"ا", "إ":"ا", "آ":"ا", "ى":"ي", "ة":"ه"})
+
+def normalize_name(name):
+    # "أحمد  عليّ" and "احمد علي" must hit the same roster entry
+    name = _AR_MARKS.sub("", str(name)).translate(_AR_LETTERS)
+    return " ".join(name.split()).casefold()
+
+def chunks(seq, size=500):
+    for i in range(0, len(seq), size):
+        yield seq[i:i+size]
+
+def read_roster(db, df, class_id=None):
+    """Turn an uploaded sheet into (class_id, name) pairs.
+
+    A per-class upload only needs a الطالب column; a whole-school upload names each row's
+    class in الفصل (plus الصف when several grades share a class name). Returns (roster, error).
+    """
+    if "الطالب" not in df.columns:
+        return None, "يجب أن يحتوي الملف على عمود باسم 'الطالب'"
+    df = df.dropna(subset=["الطالب"])
+    names = df["الطالب"].astype(str).str.strip().tolist()
+    if class_id is not None:
+        return [(class_id, n) for n in names if n], None
+    if "الفصل" not in df.columns:
+        return None, "يجب أن يحتوي ملف المدرسة على عمود باسم 'الفصل'"
+    by_name, by_grade = {}, {}
+    for cid, cname, grade in db.query(Class.id, Class.name, Class.grade).all():
+        by_name.setdefault(cname.strip(), []).append(cid)
+        by_grade[((grade or "").strip(), cname.strip())] = cid
+    class_col = df["الفصل"].fillna("").astype(str).str.strip().tolist()
+    grade_col = df["الصف"].fillna("").astype(str).str.strip().tolist() if "الصف" in df.columns else None
+    roster, unknown = [], set()
+    for i, name in enumerate(names):
+        if not name: continue
+        cname = class_col[i]
+        if grade_col is not None:
+            cid = by_grade.get((grade_col[i], cname))
+        else:
+            ids = by_name.get(cname, [])
+            cid = ids[0] if len(ids) == 1 else None
+        if cid is None:
+            unknown.add(f"{grade_col[i]} {cname}".strip() if grade_col is not None else cname)
+            continue
+        roster.append((cid, name))
+    if unknown:
+        return None, "فصول غير معروفة أو مكررة (أضف عمود 'الصف'): " + "، ".join(sorted(unknown))
+    return roster, None
+
+STUDENT_RECORD_TABLES = (Attendance, Behavior, Works, HomeworkGrade, TestGrade)
+
+def student_record_counts(db, ids):
+    counts = {}
+    for ids_chunk in chunks(list(ids)):
+        for table in STUDENT_RECORD_TABLES:
+            for sid, n in db.query(table.student_id, func.count()).filter(table.student_id.in_(ids_chunk)).group_by(table.student_id):
+                counts[sid] = counts.get(sid, 0) + n
+    return counts
+
+def compute_roster_diff(db, roster):
+    """Diff (class_id, name) pairs against the school's current students.
+
+    Returns new / unchanged / moved / ambiguous / removed entries, each tagged with its target class.
+    A name listed n times matches up to n existing copies in its class; further copies are duplicates,
+    and the copies with the most attendance/behavior/grade records are the ones kept.
+    Names matching several students elsewhere are never inserted; they land in ambiguous for the
+    teacher to pick from.
+    """
+    class_names = dict(db.query(Class.id, Class.name).all())
+    index, current = {}, {}
+    for sid, full_name, cid in db.query(Student.id, Student.full_name, Student.class_id).all():
+        key = normalize_name(full_name)
+        index.setdefault(key, []).append((sid, full_name, cid))
+        current.setdefault((cid, key), []).append((sid, full_name))
+    wanted, display = {}, {}
+    for cid, name in roster:
+        key = normalize_name(name)
+        if not key: continue
+        wanted[(cid, key)] = wanted.get((cid, key), 0) + 1
+        display.setdefault((cid, key), " ".join(str(name).split()))
+    copies = {k: current[k] for k in wanted if len(current.get(k, [])) > 1}
+    records = student_record_counts(db, [sid for cs in copies.values() for sid, _ in cs]) if copies else {}
+    diff = {"new": [], "unchanged": [], "moved": [], "ambiguous": [], "removed": []}
+    claimed, keep, pending = set(), {}, []
+    for (cid, key), n in wanted.items():
+        here = sorted(current.get((cid, key), []), key=lambda c: (-records.get(c[0], 0), c[0]))
+        for sid, full_name in here[:n]:
+            claimed.add(sid)
+            diff["unchanged"].append({"id": sid, "full_name": full_name, "class_id": cid, "class_name": class_names.get(cid, "—")})
+        if here: keep[(cid, key)] = here[0][0]
+        pending += [(cid, key, display[(cid, key)])] * max(0, n - len(here))
+    for cid, key, name in pending:
+        # extra copies in a class that lists this name are duplicates, not transfer candidates
+        cands = [m for m in index.get(key, []) if m[0] not in claimed and (m[2], key) not in wanted]
+        target = {"class_id": cid, "class_name": class_names.get(cid, "—")}
+        if not cands:
+            diff["new"].append({"full_name": name, **target})
+        elif len(cands) == 1:
+            sid, full_name, from_cid = cands[0]
+            claimed.add(sid)
+            diff["moved"].append({"id": sid, "full_name": full_name, "from_class": class_names.get(from_cid, "—"), **target})
+        else:
+            options = [{"id": sid, "full_name": full_name, "from_class": class_names.get(from_cid, "—")} for sid, full_name, from_cid in cands]
+            diff["ambiguous"].append({"full_name": name, "options": options, **target})
+    targets = {cid for cid, _ in wanted}
+    for (cid, key), studs in current.items():
+        if cid not in targets: continue
+        for sid, full_name in studs:
+            if sid in claimed: continue
+            diff["removed"].append({"id": sid, "full_name": full_name, "duplicate": (cid, key) in wanted, "keep_id": keep.get((cid, key)),
+                                    "records": records.get(sid, 0), "class_id": cid, "class_name": class_names.get(cid, "—")})
+    return diff
+
+def merge_student_records(db, from_id, to_id):
+    # a grade the kept copy already has wins; the duplicate's conflicting row goes with the duplicate
+    for table in STUDENT_RECORD_TABLES:
+        stmt = update(table).where(table.student_id == from_id)
+        if table is HomeworkGrade:
+            stmt = stmt.where(table.homework_id.not_in(select(HomeworkGrade.homework_id).where(HomeworkGrade.student_id == to_id)))
+        elif table is TestGrade:
+            stmt = stmt.where(table.test_id.not_in(select(TestGrade.test_id).where(TestGrade.student_id == to_id)))
+        ids = db.scalars(stmt.values(student_id=to_id).returning(table.id)).all()
+        record_changes(db, table.__tablename__, ids, "update")
+        if table in (HomeworkGrade, TestGrade):
+            ids = db.scalars(delete(table).where(table.student_id == from_id).returning(table.id)).all()
+            record_changes(db, table.__tablename__, ids, "delete")
+
+def apply_roster_diff(db, diff, move=True, remove=None, picks=None):
+    """Write a diff in bulk. remove is None, "duplicates" or "all"; picks maps an ambiguous entry's
+    position to the student id the teacher chose for it."""
+    moves = [(m["id"], m["class_id"]) for m in diff["moved"]] if move else []
+    for i, sid in (picks or {}).items():
+        if 0 <= i < len(diff["ambiguous"]):
+            entry = diff["ambiguous"][i]
+            if sid in {o["id"] for o in entry["options"]}: moves.append((sid, entry["class_id"]))
+    moving = {}
+    for sid, cid in moves:
+        if all(sid not in ids for ids in moving.values()): moving.setdefault(cid, []).append(sid)
+    moved_ids = {sid for ids in moving.values() for sid in ids}
+    removing = [r for r in diff["removed"] if r["id"] not in moved_ids and (remove == "all" or (remove == "duplicates" and r["duplicate"]))]
+    # bulk statements bypass after_flush, so they log their own changes
+    if diff["new"]:
+        ids = db.scalars(insert(Student).returning(Student.id), [{"full_name": n["full_name"], "class_id": n["class_id"]} for n in diff["new"]]).all()
+        record_changes(db, "students", ids, "insert")
+    for cid, sids in moving.items():
+        for ids in chunks(sids):
+            db.execute(update(Student).where(Student.id.in_(ids)).values(class_id=cid))
+            record_changes(db, "students", ids, "update")
+    for r in removing:
+        if r["duplicate"] and r["keep_id"]: merge_student_records(db, r["id"], r["keep_id"])
+    for ids in chunks([r["id"] for r in removing]):
+        db.execute(delete(Student).where(Student.id.in_(ids)))
+        record_changes(db, "students", ids, "delete")
+    return {"new": len(diff["new"]), "moved": len(moved_ids), "removed": len(removing), "unchanged": len(diff["unchanged"])}
 
 def saudi_school_dow():
     d = datetime.now(TZ).weekday()  # Mon=0
@@ -148,9 +425,12 @@ def saudi_school_dow():
     return mapping.get(d, 0)
 
 def get_todays_schedule():
+    dow = saudi_school_dow()
+    return list(schedule_cache.get(dow, lambda: load_schedule(dow)))
+
+def load_schedule(dow):
     db = SessionLocal()
     try:
-        dow = saudi_school_dow()
         sch = (db.query(Schedule, Class)
                .join(Class, Schedule.class_id==Class.id)
                .filter(Schedule.day_of_week==dow)
@@ -167,6 +447,101 @@ def get_todays_schedule():
 def inject_teacher():
     return {"teacher_name": get_setting("teacher_name", "معلم العلوم")}
 
+# Response compression & static caching
+
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_MIMETYPES = {"text/html", "application/json", "text/css", "text/javascript", "application/javascript"}
+STATIC_MAX_AGE = 365*24*3600
+_static_hashes = {}
+_static_compressed = {}  # (filename, hash, encoding) -> bytes, built once per asset version
+
+def static_file_hash(filename):
+    path = os.path.join(app.static_folder, filename)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    cached = _static_hashes.get(filename)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:12]
+    _static_hashes[filename] = (mtime, digest)
+    return digest
+
+@app.url_defaults
+def fingerprint_static(endpoint, values):
+    if endpoint == "static" and "filename" in values and "v" not in values:
+        digest = static_file_hash(values["filename"])
+        if digest: values["v"] = digest
+
+@app.after_request
+def cache_static(resp):
+    v = request.args.get("v")
+    if request.endpoint == "static" and v and resp.status_code in (200, 206, 304) and v == static_file_hash(request.view_args["filename"]):
+        resp.cache_control.no_cache = None
+        resp.cache_control.public = True
+        resp.cache_control.max_age = STATIC_MAX_AGE
+        resp.cache_control.immutable = True
+    return resp
+
+def compress(data, encoding, static=False):
+    if encoding == "br":
+        return brotli.compress(data, quality=11 if static else 5)
+    return gzip.compress(data, compresslevel=9 if static else 6)
+
+def compress_static(resp):
+    filename = request.view_args["filename"]
+    if mimetypes.guess_type(filename)[0] not in COMPRESS_MIMETYPES:
+        return resp
+    # 200, 206 and 304 for the same URL must agree on Vary and ETag strength
+    resp.vary.add("Accept-Encoding")
+    path = os.path.join(app.static_folder, filename)
+    digest = static_file_hash(filename)
+    encoding = request.accept_encodings.best_match(["br", "gzip"])
+    if not digest or not encoding or os.path.getsize(path) < COMPRESS_MIN_SIZE:
+        return resp
+    etag, _ = resp.get_etag()
+    if resp.status_code == 304:
+        resp.headers.pop("Accept-Ranges", None)
+        if etag: resp.set_etag(etag, weak=True)
+        return resp
+    if resp.status_code != 200 or "Content-Encoding" in resp.headers:
+        return resp
+    data = _static_compressed.get((filename, digest, encoding))
+    if data is None:
+        with open(path, "rb") as f:
+            data = _static_compressed[(filename, digest, encoding)] = compress(f.read(), encoding, static=True)
+    resp.close()
+    resp.direct_passthrough = False
+    resp.set_data(data)
+    resp.headers["Content-Encoding"] = encoding
+    # byte ranges would address the identity file, not this body
+    resp.headers.pop("Accept-Ranges", None)
+    # same content, different bytes: a weak ETag keeps If-None-Match revalidation working
+    if etag: resp.set_etag(etag, weak=True)
+    return resp
+
+@app.after_request
+def compress_response(resp):
+    if request.endpoint == "static":
+        return compress_static(resp)
+    # xlsx/docx exports are zip containers already, so only text types are compressed
+    if resp.status_code != 200 or "Content-Encoding" in resp.headers or resp.mimetype not in COMPRESS_MIMETYPES:
+        return resp
+    resp.vary.add("Accept-Encoding")
+    if resp.direct_passthrough or (resp.content_length is not None and resp.content_length < COMPRESS_MIN_SIZE):
+        return resp
+    encoding = request.accept_encodings.best_match(["br", "gzip"])
+    if not encoding:
+        return resp
+    data = resp.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return resp
+    resp.set_data(compress(data, encoding))
+    resp.headers["Content-Encoding"] = encoding
+    return resp
+
 @app.route("/")
 def index():
     schedule = get_todays_schedule()
@@ -234,19 +609,55 @@ def delete_student(class_id, student_id):
 
 @app.route("/students/<int:class_id>/import", methods=["POST"]) 
 def import_students(class_id):
+    db = SessionLocal()
+    try:
+        cls = db.query(Class).get(class_id)
+        if not cls: flash("الفصل غير موجود.","error"); return redirect(url_for("classes"))
+        file = request.files.get("file")
+        if not file: flash("لم يتم رفع ملف.","error"); return redirect(url_for("students", class_id=class_id))
+        roster, err = read_roster(db, pd.read_excel(file, engine="openpyxl"), class_id)
+        if err: flash(err, "error"); return redirect(url_for("students", class_id=class_id))
+        diff = compute_roster_diff(db, roster)
+        # a class moving up a grade looks like this, but so does a whole-school sheet uploaded to one class
+        mass_move = len(diff["moved"]) >= 10 and len(diff["moved"]) * 2 >= len(roster)
+        return render_template("students_import.html", cls=cls, diff=diff, roster=roster, mass_move=mass_move)
+    finally:
+        db.close()
+
+@app.route("/classes/import", methods=["POST"]) 
+def import_school_roster():
     file = request.files.get("file")
-    if not file: flash("لم يتم رفع ملف.","error"); return redirect(url_for("students", class_id=class_id))
+    if not file: flash("لم يتم رفع ملف.","error"); return redirect(url_for("classes"))
     db = SessionLocal()
     try:
-        df = pd.read_excel(file, engine="openpyxl")
-        if "الطالب" not in df.columns:
-            flash("يجب أن يحتوي الملف على عمود باسم 'الطالب'", "error"); return redirect(url_for("students", class_id=class_id))
-        count=0
-        for name in df["الطالب"].dropna().astype(str).str.strip().tolist():
-            if name:
-                db.add(Student(full_name=name, class_id=class_id)); count+=1
-        db.commit(); flash(f"تم استيراد {count} طالب.", "success")
-        return redirect(url_for("students", class_id=class_id))
+        roster, err = read_roster(db, pd.read_excel(file, engine="openpyxl"))
+        if err: flash(err, "error"); return redirect(url_for("classes"))
+        diff = compute_roster_diff(db, roster)
+        return render_template("students_import.html", cls=None, diff=diff, roster=roster)
+    finally:
+        db.close()
+
+@app.route("/roster/apply", methods=["POST"]) 
+def apply_import_roster():
+    back = request.form.get("class_id", type=int)
+    back_url = url_for("students", class_id=back) if back else url_for("classes")
+    db = SessionLocal()
+    try:
+        try:
+            roster = [(int(cid), str(name)) for cid, name in json.loads(request.form.get("roster", ""))]
+            picks = {int(k[len("pick_"):]): int(v) for k, v in request.form.items() if k.startswith("pick_") and v}
+        except (ValueError, TypeError):
+            flash("بيانات المزامنة غير صالحة، أعد رفع الملف.", "error"); return redirect(back_url)
+        known = {cid for (cid,) in db.query(Class.id).all()}
+        if not roster or any(cid not in known for cid, _ in roster) or (back and back not in known):
+            flash("الفصل غير موجود.", "error"); return redirect(url_for("classes"))
+        # recompute against the current roster so a stale preview can't double-insert
+        diff = compute_roster_diff(db, roster)
+        remove = request.form.get("remove") if request.form.get("remove") in ("duplicates", "all") else None
+        counts = apply_roster_diff(db, diff, move=request.form.get("move") == "1", remove=remove, picks=picks)
+        db.commit()
+        flash(f"تمت مزامنة القائمة: {counts['new']} جديد، {counts['moved']} منقول، {counts['removed']} محذوف، {counts['unchanged']} دون تغيير.", "success")
+        return redirect(back_url)
     finally:
         db.close()
 